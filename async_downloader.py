@@ -0,0 +1,143 @@
+import os
+import asyncio
+import logging
+from contextlib import aclosing
+from pathlib import Path
+
+import httpx
+
+from bandwidth import bandwidth_governor, INGRESS
+
+logger = logging.getLogger(__name__)
+
+# Настраиваемые параметры
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(10 * 1024 * 1024)))  # bytes per ranged request
+DOWNLOAD_READ_SIZE = int(os.getenv("DOWNLOAD_READ_SIZE", str(1024 * 1024)))  # bytes per socket read
+DOWNLOAD_WRITE_BUFFER = int(os.getenv("DOWNLOAD_WRITE_BUFFER", str(8 * 1024 * 1024)))  # bytes per disk write
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", str(16 * 1024 * 1024)))  # in-memory buffer for diskless delivery
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+DOWNLOAD_RETRIES = 3
+
+_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared keep-alive HTTP client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            timeout=httpx.Timeout(60, connect=10),
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Closes the shared HTTP client and its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def iter_stream(url: str, filesize: int, user_id: int = None):
+    """
+    Yields the content of a stream URL in DOWNLOAD_READ_SIZE pieces.
+    YouTube throttles long unranged responses, so known-size streams are
+    fetched as consecutive `&range=` requests of DOWNLOAD_CHUNK_SIZE bytes
+    over the shared connection pool, resuming after network errors.
+    Every piece is paced by the bandwidth governor's ingress budget.
+    """
+    client = get_http_client()
+
+    if not filesize:
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for data in response.aiter_bytes(DOWNLOAD_READ_SIZE):
+                await bandwidth_governor.throttle(INGRESS, len(data), user_id)
+                yield data
+        return
+
+    downloaded = 0
+    failures = 0
+    while downloaded < filesize:
+        start = downloaded
+        stop = min(start + DOWNLOAD_CHUNK_SIZE, filesize) - 1
+        try:
+            async with client.stream("GET", f"{url}&range={start}-{stop}") as response:
+                response.raise_for_status()
+                async for data in response.aiter_bytes(DOWNLOAD_READ_SIZE):
+                    await bandwidth_governor.throttle(INGRESS, len(data), user_id)
+                    downloaded += len(data)
+                    yield data
+        except httpx.TransportError as e:
+            # Resume from the last received byte
+            failures += 1
+            if failures >= DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f"Range {start}-{stop} failed at byte {downloaded} ({e}), retrying ({failures}/{DOWNLOAD_RETRIES})")
+            continue
+        if downloaded == start:
+            raise RuntimeError(f"Empty response for range {start}-{stop}.")
+        failures = 0
+        logger.info(f"Downloaded {downloaded / 1_048_576:.2f}/{filesize / 1_048_576:.2f} MiB ({downloaded * 100 / filesize:5.1f}%)")
+
+
+def _write_batch(fh, batch: list) -> None:
+    fh.write(b"".join(batch))
+
+
+async def download_stream(url: str, path: Path, filesize: int, user_id: int = None) -> str:
+    """
+    Downloads a stream URL to `path` and returns the path. Pieces are collected
+    into batches of about DOWNLOAD_WRITE_BUFFER bytes, and each batch is written
+    in a worker thread so disk writes never block the event loop.
+    """
+    fh = await asyncio.to_thread(open, path, "wb")
+    try:
+        batch, batch_size = [], 0
+        async with aclosing(iter_stream(url, filesize, user_id)) as chunks:
+            async for data in chunks:
+                batch.append(data)
+                batch_size += len(data)
+                if batch_size >= DOWNLOAD_WRITE_BUFFER:
+                    await asyncio.to_thread(_write_batch, fh, batch)
+                    batch, batch_size = [], 0
+        if batch:
+            await asyncio.to_thread(_write_batch, fh, batch)
+    finally:
+        await asyncio.to_thread(fh.close)
+    return str(path)
+
+
+async def buffered(chunks, max_bytes: int = STREAM_BUFFER_SIZE):
+    """
+    Reads an async iterator of chunks ahead into a bounded in-memory queue,
+    so that the producer (download) and the consumer (upload) run
+    concurrently without holding more than about `max_bytes` in memory.
+    """
+    queue = asyncio.Queue(maxsize=max(1, max_bytes // DOWNLOAD_READ_SIZE))
+    done = object()
+
+    async def produce():
+        try:
+            # aclosing() releases the source (e.g. a pooled connection) as soon as the producer is cancelled
+            async with aclosing(chunks) as source:
+                async for data in source:
+                    await queue.put(data)
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
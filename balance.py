@@ -1,17 +1,33 @@
+import os
+import time
 import sqlite3
+import threading
+from collections import OrderedDict
 from pathlib import Path
 import logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 DB_FILE = Path("balances.db")
 STARTING_BALANCE = 100  # Credits for new users
 
+# Кэш балансов: чтения из памяти, все изменения пишутся сразу и в БД, и в кэш
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "10000"))
+_balance_cache = OrderedDict()  # user_id -> balance, in LRU order
+# Held across each DB write and the matching cache update, so readers never see a stale value
+_balance_lock = threading.RLock()
+_balance_generation = 0  # bumped on every cache write, lets verify_balance_cache detect concurrent updates
+BALANCE_CHECK_CHUNK = 500  # user IDs per query (SQLite limits the number of bound parameters)
+
+# Статусы счетов CryptoBot
+INVOICE_PENDING = "pending"
+INVOICE_PAID = "paid"
+INVOICE_EXPIRED = "expired"
+
 def init_db():
-    """Initializes the database and creates the users table if it doesn't exist."""
+    """
+    Initializes the database and creates the tables if they don't exist.
+    Must be called once at startup, before any other function of this module.
+    """
     with sqlite3.connect(DB_FILE) as conn:
         cursor = conn.cursor()
         cursor.execute("""
@@ -20,53 +36,91 @@ def init_db():
                 balance INTEGER NOT NULL
             )
         """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS crypto_invoices (
+                invoice_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                credits INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                created_at REAL NOT NULL
+            )
+        """)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_crypto_invoices_status ON crypto_invoices (status)"
+        )
         conn.commit()
 
+def _cache_balance(user_id: int, balance: int) -> None:
+    global _balance_generation
+    _balance_generation += 1
+    _balance_cache[user_id] = balance
+    _balance_cache.move_to_end(user_id)
+    while len(_balance_cache) > BALANCE_CACHE_SIZE:
+        _balance_cache.popitem(last=False)
+
 def get_balance(user_id: int) -> int:
     """Gets a user's balance, creating a new record if they are new."""
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            return result[0]
-        else:
-            # User not found, create a new entry
-            cursor.execute(
-                "INSERT INTO users (user_id, balance) VALUES (?, ?)", 
-                (user_id, STARTING_BALANCE)
-            )
-            conn.commit()
-            return STARTING_BALANCE
+    with _balance_lock:
+        balance = _balance_cache.get(user_id)
+        if balance is not None:
+            _balance_cache.move_to_end(user_id)
+            return balance
+
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
+            
+            if result:
+                balance = result[0]
+            else:
+                # User not found, create a new entry
+                cursor.execute(
+                    "INSERT INTO users (user_id, balance) VALUES (?, ?)", 
+                    (user_id, STARTING_BALANCE)
+                )
+                conn.commit()
+                balance = STARTING_BALANCE
+
+        _cache_balance(user_id, balance)
+        return balance
+
+def _add_balance(cursor, user_id: int, amount: int) -> int:
+    """Adds to a balance within the caller's transaction and returns the new balance."""
+    cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    
+    if result:
+        new_balance = result[0] + amount
+        cursor.execute(
+            "UPDATE users SET balance = ? WHERE user_id = ?", 
+            (new_balance, user_id)
+        )
+    else:
+        # User not found, create a new entry with the topped-up balance
+        new_balance = STARTING_BALANCE + amount
+        cursor.execute(
+            "INSERT INTO users (user_id, balance) VALUES (?, ?)", 
+            (user_id, new_balance)
+        )
+    return new_balance
 
 def add_balance(user_id: int, amount: int) -> None:
     """Adds the specified amount to the user's balance."""
-    with sqlite3.connect(DB_FILE) as conn:
+    with _balance_lock, sqlite3.connect(DB_FILE) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            new_balance = result[0] + amount
-            cursor.execute(
-                "UPDATE users SET balance = ? WHERE user_id = ?", 
-                (new_balance, user_id)
-            )
-        else:
-            # User not found, create a new entry with the topped-up balance
-            cursor.execute(
-                "INSERT INTO users (user_id, balance) VALUES (?, ?)", 
-                (user_id, STARTING_BALANCE + amount)
-            )
+        new_balance = _add_balance(cursor, user_id, amount)
         conn.commit()
+        # The cache is only touched after a successful commit, so a failed write leaves it valid
+        _cache_balance(user_id, new_balance)
 
 def update_balance(user_id: int, cost: int) -> bool:
     """
     Updates a user's balance by deducting the cost in a transaction-safe way.
     Returns True if the balance was sufficient, False otherwise.
     """
-    with sqlite3.connect(DB_FILE) as conn:
+    with _balance_lock, sqlite3.connect(DB_FILE) as conn:
         cursor = conn.cursor()
         try:
             # Get current balance
@@ -92,68 +146,125 @@ def update_balance(user_id: int, cost: int) -> bool:
                     (new_balance, user_id)
                 )
                 conn.commit()
+                _cache_balance(user_id, new_balance)
                 return True
             else:
                 # Not enough balance, roll back any potential changes (like user creation)
                 conn.rollback()
+                if result:
+                    _cache_balance(user_id, current_balance)
                 return False
         except sqlite3.Error as e:
             logger.error(f"Database error: {e}")
             conn.rollback()
             return False
 
-def calculate_video_cost(resolution: str, filesize_mb: int) -> int:
-    # Настраиваемые параметры:
-    base_cost_by_resolution = {
-        "480p": 1,
-        "720p": 3,
-        "1080p": 6,
-        "1440p": 9,
-        "4K": 12,
-    }
+def _fetch_balances(user_ids: list) -> dict:
+    placeholders = ",".join("?" * len(user_ids))
+    with sqlite3.connect(DB_FILE) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT user_id, balance FROM users WHERE user_id IN ({placeholders})", user_ids)
+        return dict(cursor.fetchall())
 
-    # Максимальное качество и размер, при которых видео можно скачать бесплатно
-    max_free_filesize_mb = 100  # MB
-    max_free_resolution = "720p"  # всё ниже или равно — может быть бесплатным
+def verify_balance_cache() -> int:
+    """
+    Compares every cached balance with the database (e.g. after a manual DB
+    edit), fixes mismatches and returns how many entries were wrong.
+    Only cached users are queried, in chunks; the lock is held just for the
+    comparison, unless a balance changed while a chunk was being read.
+    """
+    with _balance_lock:
+        user_ids = list(_balance_cache)
 
-    # Функция сравнения разрешений (по порядку качества)
-    resolution_order = ["144p", "240p", "360p", "480p", "720p", "1080p", "1440p", "4K", "8K"]
+    mismatches = 0
+    for i in range(0, len(user_ids), BALANCE_CHECK_CHUNK):
+        chunk = user_ids[i:i + BALANCE_CHECK_CHUNK]
+        with _balance_lock:
+            generation = _balance_generation
+        db_balances = _fetch_balances(chunk)
 
-    def resolution_leq(r1, r2):
-        try:
-            return resolution_order.index(r1) <= resolution_order.index(r2)
-        except ValueError:
-            return False
+        with _balance_lock:
+            if _balance_generation != generation:
+                # A write landed while we were reading: re-read under the lock so it cannot be undone
+                db_balances = _fetch_balances(chunk)
+            for user_id in chunk:
+                balance = _balance_cache.get(user_id)
+                if balance is None:
+                    continue  # evicted meanwhile
+                db_balance = db_balances.get(user_id)
+                if db_balance == balance:
+                    continue
+                mismatches += 1
+                logger.warning(f"Balance cache mismatch for user {user_id}: cached {balance}, DB {db_balance}")
+                if db_balance is None:
+                    del _balance_cache[user_id]
+                else:
+                    _balance_cache[user_id] = db_balance
+    return mismatches
 
-    # Проверка на бесплатность
-    if filesize_mb <= max_free_filesize_mb and resolution_leq(resolution, max_free_resolution):
-        return 0
-
-    # Получаем базовую цену
-    base_cost = base_cost_by_resolution.get(resolution)
-    if base_cost is None:
-        if resolution_leq(resolution, "480p"):
-            base_cost = 1
-        else:
-            base_cost = max(base_cost_by_resolution.values())
-
-    # Расчёт стоимости с учётом размера (чем больше — тем дороже)
-    if filesize_mb <= 50:
-        multiplier = 1
-    elif filesize_mb <= 200:
-        multiplier = 2
-    elif filesize_mb <= 500:
-        multiplier = 3
-    elif filesize_mb <= 1024: # 1GB
-        multiplier = 4
-    elif filesize_mb <= 2048: # 2GB
-        multiplier = 5
-    else:
-        multiplier = 10
+def add_crypto_invoice(invoice_id: int, user_id: int, chat_id: int, credits: int) -> None:
+    """Stores a newly created CryptoBot invoice as pending."""
+    with sqlite3.connect(DB_FILE) as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO crypto_invoices (invoice_id, user_id, chat_id, credits, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (invoice_id, user_id, chat_id, credits, INVOICE_PENDING, time.time())
+        )
+        conn.commit()
+
+def get_crypto_invoice(invoice_id: int):
+    """Returns (user_id, credits, status) for an invoice, or None if unknown."""
+    with sqlite3.connect(DB_FILE) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT user_id, credits, status FROM crypto_invoices WHERE invoice_id = ?", (invoice_id,)
+        )
+        return cursor.fetchone()
+
+def get_pending_crypto_invoices() -> list:
+    """Returns (invoice_id, created_at) for every invoice that is still pending."""
+    with sqlite3.connect(DB_FILE) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT invoice_id, created_at FROM crypto_invoices WHERE status = ?", (INVOICE_PENDING,)
+        )
+        return cursor.fetchall()
 
-    # Итоговая цена
-    final_cost = round(base_cost * multiplier)
-    return final_cost
+def credit_crypto_invoice(invoice_id: int):
+    """
+    Marks a pending invoice as paid and credits its owner in one transaction.
+    Returns (user_id, chat_id, credits), or None if the invoice was already
+    processed, so repeated calls never credit twice.
+    """
+    with _balance_lock, sqlite3.connect(DB_FILE) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "UPDATE crypto_invoices SET status = ? WHERE invoice_id = ? AND status = ?",
+                (INVOICE_PAID, invoice_id, INVOICE_PENDING)
+            )
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return None
+
+            cursor.execute(
+                "SELECT user_id, chat_id, credits FROM crypto_invoices WHERE invoice_id = ?", (invoice_id,)
+            )
+            user_id, chat_id, credits = cursor.fetchone()
+            new_balance = _add_balance(cursor, user_id, credits)
+            conn.commit()
+            _cache_balance(user_id, new_balance)
+            return user_id, chat_id, credits
+        except sqlite3.Error as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            return None
 
-# Initialize the database when the module is loaded
-init_db()
\ No newline at end of file
+def expire_crypto_invoice(invoice_id: int) -> None:
+    """Marks a pending invoice as expired."""
+    with sqlite3.connect(DB_FILE) as conn:
+        conn.execute(
+            "UPDATE crypto_invoices SET status = ? WHERE invoice_id = ? AND status = ?",
+            (INVOICE_EXPIRED, invoice_id, INVOICE_PENDING)
+        )
+        conn.commit()
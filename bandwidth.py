@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Настраиваемые параметры (байт/с, 0 — без ограничения)
+BANDWIDTH_INGRESS_BPS = int(os.getenv("BANDWIDTH_INGRESS_BPS", "0"))
+BANDWIDTH_EGRESS_BPS = int(os.getenv("BANDWIDTH_EGRESS_BPS", "0"))
+BANDWIDTH_PER_USER_BPS = int(os.getenv("BANDWIDTH_PER_USER_BPS", "0"))
+BANDWIDTH_QUANTUM = 64 * 1024  # bytes granted per turn
+
+INGRESS = "ingress"
+EGRESS = "egress"
+
+
+class TokenBucket:
+    """
+    Token bucket limiting a byte rate. Callers are served strictly in
+    arrival order (asyncio.Lock is FIFO), so transfers that request small
+    quanta take turns instead of one large transfer draining the bucket.
+    """
+
+    def __init__(self, rate: int, burst: int = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, amount: int) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens < 0:
+                # Wait until the debt is paid off; later callers queue behind us
+                await asyncio.sleep(-self._tokens / self.rate)
+
+
+class BandwidthGovernor:
+    """
+    Shares ingress (YouTube downloads) and egress (Telegram uploads)
+    bandwidth between all running transfers.
+
+    Every chunk is passed through `throttle`, which splits it into quanta
+    and queues each quantum on the global bucket for its direction. Because
+    the queue is FIFO, active jobs get equal turns (a fair share each) while
+    the link stays saturated; an optional per-user bucket caps a single
+    user's jobs on top of that.
+    """
+
+    def __init__(self, ingress_rate: int = BANDWIDTH_INGRESS_BPS, egress_rate: int = BANDWIDTH_EGRESS_BPS,
+                 per_user_rate: int = BANDWIDTH_PER_USER_BPS, quantum: int = BANDWIDTH_QUANTUM):
+        self.per_user_rate = per_user_rate
+        self.quantum = quantum
+        self._buckets = {
+            INGRESS: TokenBucket(ingress_rate) if ingress_rate else None,
+            EGRESS: TokenBucket(egress_rate) if egress_rate else None,
+        }
+        self._user_buckets = {}  # user_id -> {direction: TokenBucket}
+        self._user_jobs = {}  # user_id -> number of active jobs
+
+    @contextmanager
+    def job(self, user_id: int):
+        """Registers a running job so that its user's buckets live exactly as long as needed."""
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        if self.per_user_rate and user_id not in self._user_buckets:
+            self._user_buckets[user_id] = {
+                INGRESS: TokenBucket(self.per_user_rate),
+                EGRESS: TokenBucket(self.per_user_rate),
+            }
+        try:
+            yield
+        finally:
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+                self._user_buckets.pop(user_id, None)
+
+    async def throttle(self, direction: str, amount: int, user_id: int = None) -> None:
+        """Waits until `amount` bytes may be transferred in the given direction."""
+        bucket = self._buckets[direction]
+        user_bucket = self._user_buckets.get(user_id, {}).get(direction)
+        if not bucket and not user_bucket:
+            return
+
+        while amount > 0:
+            quantum = min(amount, self.quantum)
+            if user_bucket:
+                await user_bucket.consume(quantum)
+            if bucket:
+                await bucket.consume(quantum)
+            amount -= quantum
+
+
+bandwidth_governor = BandwidthGovernor()
@@ -1,20 +1,40 @@
+import time
+_startup_mark = time.perf_counter()
+
 import os
-import uuid
+import bisect
 import asyncio
+import warnings
+import importlib
 from collections import deque
 from pathlib import Path
 
 from dotenv import load_dotenv
-from aiocryptopay import AioCryptoPay, Networks
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, LabeledPrice
 from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler, PreCheckoutQueryHandler
 
-from yt_downloader import get_video_streams
-from balance import get_balance, update_balance, calculate_video_cost, add_balance
-from queue_manager import add_to_queue, queue_processor
+from yt_downloader import get_video_streams, extract_video_id, extract_youtube_urls, is_playlist_url, expand_video_urls
+from balance import init_db, get_balance, update_balance, add_balance, verify_balance_cache
+from pricing import calculate_video_cost, calculate_audio_cost
+from queue_manager import add_to_queue, add_batch_to_queue, check_admission, format_eta, is_streamable, queue_processor
+from selection_store import SelectionStore
+from async_downloader import close_http_client
 from topup_stars import show_stars_packages, select_stars_package_handler
-from topup_crypto import handle_crypto_topup, check_crypto_payment_handler
+from topup_crypto import handle_crypto_topup, check_crypto_payment_handler, crypto_invoice_poller
+
+# Длительность этапов запуска (мс), пишется в лог после post_init
+STARTUP_PHASES = {}
+
+
+def mark_startup_phase(name: str) -> None:
+    global _startup_mark
+    now = time.perf_counter()
+    STARTUP_PHASES[name] = (now - _startup_mark) * 1000
+    _startup_mark = now
+
+
+mark_startup_phase("imports")
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -22,15 +42,33 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_USER_IDS = [int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x]
 CRYPTO_BOT_TOKEN = os.getenv("CRYPTO_BOT_TOKEN")
 
-# Инициализация CryptoBot
+# Инициализация CryptoBot (aiocryptopay импортируется, только если он настроен)
 if CRYPTO_BOT_TOKEN:
+    from aiocryptopay import AioCryptoPay, Networks
     cryptopay = AioCryptoPay(token=CRYPTO_BOT_TOKEN, network=Networks.MAIN_NET)
 else:
     cryptopay = None
 
-# Директория для скачивания
+# Как часто сверять кэш балансов с БД (секунды)
+BALANCE_CACHE_CHECK_INTERVAL = int(os.getenv("BALANCE_CACHE_CHECK_INTERVAL", "600"))
+
+# Пакетная загрузка (плейлисты и несколько ссылок)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_METADATA_CONCURRENCY = int(os.getenv("BATCH_METADATA_CONCURRENCY", "4"))
+BATCH_POLICIES = {
+    "720": "🎬 Лучшее ≤720p",
+    "1080": "🎬 Лучшее ≤1080p",
+    "audio": "🎵 Только аудио",
+}
+
+# Меню выбора формата, ожидающие ответа пользователя
+selection_store = SelectionStore()
+
+# Сколько последних подтверждённых сообщений помнить на пользователя (защита от двойного нажатия)
+CONFIRMED_MESSAGES_KEPT = 20
+
+# Директория для скачивания (создаётся при запуске в main)
 DOWNLOAD_DIR = Path("downloads")
-DOWNLOAD_DIR.mkdir(exist_ok=True)
 
 # Настройка логирования
 import logging
@@ -176,46 +214,86 @@ async def successful_payment_handler(update: Update, context: CallbackContext) -
         )
 
 
+def stream_label(stream: dict) -> str:
+    """Returns a short label for a stream option, e.g. "📹 720p"."""
+    if stream['type'] == 'video':
+        return f"📹 {stream['resolution']}"
+    return f"🎵 {stream['abr']}"
+
+
+def stream_size_text(stream: dict) -> str:
+    """Returns the stream size in MB, prefixed with "~" when it is an estimate."""
+    filesize_mb = stream.get('filesize', 0) / 1_048_576
+    return f"{'~' if stream.get('filesize_estimated') else ''}{filesize_mb:.1f} MB"
+
+
+def price_streams(streams: list) -> list:
+    """Adds the download cost to every stream option."""
+    for stream in streams:
+        filesize_mb = stream.get('filesize', 0) / 1_048_576
+        if stream['type'] == 'video':
+            try:
+                stream['cost'] = calculate_video_cost(stream['resolution'], int(filesize_mb))
+            except (ValueError, IndexError):
+                stream['cost'] = 1 # Fallback cost
+        else:  # audio
+            stream['cost'] = calculate_audio_cost(filesize_mb)
+    return streams
+
+
+def build_format_keyboard(selection_key: str, selection: dict, balance: int) -> InlineKeyboardMarkup:
+    """Builds the format keyboard; options the user cannot afford are marked with 🔒."""
+    keyboard = []
+    for stream in selection['streams'].values():
+        cost = stream['cost']
+        lock = "🔒 " if cost > balance else ""
+        if stream['type'] == 'video':
+            text = f"{lock}{stream_label(stream)} ({stream_size_text(stream)}) - {f'{cost} кред.' if cost > 0 else 'Бесплатно 💸'}"
+        else:  # audio
+            text = f"{lock}{stream_label(stream)} ({stream_size_text(stream)}) - {cost} кред."
+        callback_data = f"select:{selection_key}:{stream['itag']}"
+        keyboard.append([InlineKeyboardButton(text, callback_data=callback_data)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def render_format_menu(update: Update, selection_key: str, selection: dict, message) -> None:
+    """Показывает клавиатуру с выбором формата для сохранённого выбора."""
+    user_id = update.effective_user.id
+    balance = get_balance(user_id)
+
+    # The keyboard only depends on which price levels the balance covers,
+    # so it is rendered once per (video, balance tier) and reused
+    if 'cost_levels' not in selection:
+        selection['cost_levels'] = sorted({stream['cost'] for stream in selection['streams'].values()})
+    tier = bisect.bisect_right(selection['cost_levels'], balance)
+    reply_markup = selection['keyboards'].get(tier)
+    if reply_markup is None:
+        reply_markup = build_format_keyboard(selection_key, selection, balance)
+        selection['keyboards'][tier] = reply_markup
+
+    await message.edit_text(
+        f'Выберите формат для видео "{selection["title"]}":\n\nВаш баланс: {balance} кредитов.', 
+        reply_markup=reply_markup
+    )
+
+
 async def show_format_selection(update: Update, context: CallbackContext, url: str, message) -> None:
-    """Показывает клавиатуру с выбором формата."""
+    """Получает форматы видео и показывает клавиатуру с выбором формата."""
     try:
-        streams, title = get_video_streams(url)
-        
-        if not streams:
-            await message.edit_text("Не удалось найти доступные форматы для скачивания.")
-            return
+        video_id = extract_video_id(url)
+        selection_key = selection_store.find(video_id) if video_id else None
 
-        keyboard = []
-        url_key = str(uuid.uuid4())
-        context.user_data[url_key] = url
-
-        for stream in streams:
-            filesize_mb = stream.get('filesize', 0) / 1_048_576
-            cost = 0
-            if stream['type'] == 'video':
-                try:
-                    cost = calculate_video_cost(stream['resolution'], int(filesize_mb))
-                except (ValueError, IndexError):
-                    cost = 1 # Fallback cost
-                text = f"📹 {stream['resolution']} ({filesize_mb:.1f} MB) - {f'{cost} кред.' if cost > 0 else 'Бесплатно 💸'}"
-            else:  # audio
-                cost = max(1, int(filesize_mb // 50) + 1)
-                text = f"🎵 {stream['abr']} ({filesize_mb:.1f} MB) - {cost} кред."
+        if selection_key is None:
+            # pytubefix and the size probes block, so keep them off the event loop that runs transfers
+            streams, title = await asyncio.to_thread(get_video_streams, url)
             
-            callback_data = f"select:{stream['itag']}:{cost}:{url_key}"
-            keyboard.append([InlineKeyboardButton(text, callback_data=callback_data)])
+            if not streams:
+                await message.edit_text("Не удалось найти доступные форматы для скачивания.")
+                return
 
-        if not keyboard:
-            await message.edit_text("Не найдено подходящих форматов (mp4, до 720p).")
-            return
+            selection_key = selection_store.put(url, title, price_streams(streams), video_id)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        user_id = update.effective_user.id
-        balance = get_balance(user_id)
-        await message.edit_text(
-            f'Выберите формат для видео "{title}":\n\nВаш баланс: {balance} кредитов.', 
-            reply_markup=reply_markup
-        )
+        await render_format_menu(update, selection_key, selection_store.get(selection_key), message)
 
     except Exception as e:
         logger.error(f"Error in show_format_selection: {e}", exc_info=True)
@@ -229,13 +307,210 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
         await handle_crypto_topup(update, context, cryptopay)
         return
 
-    if not message.text or ("youtube.com/" not in message.text and "youtu.be/" not in message.text):
+    urls = extract_youtube_urls(message.text)
+    if not urls:
         await message.reply_text("Пожалуйста, отправьте действительную ссылку на YouTube.")
         return
 
-    url = message.text
-    sent_message = await message.reply_text("🔎 Получаю информацию о видео...")
-    await show_format_selection(update, context, url, sent_message)
+    if len(urls) == 1 and not is_playlist_url(urls[0]):
+        sent_message = await message.reply_text("🔎 Получаю информацию о видео...")
+        await show_format_selection(update, context, urls[0], sent_message)
+        return
+
+    sent_message = await message.reply_text("🔎 Получаю список видео...")
+    # Плейлисты могут разворачиваться долго, не блокируем обработку других сообщений
+    context.application.create_task(show_batch_policy_selection(update, context, urls, sent_message))
+
+
+def pick_stream(streams: list, policy: str):
+    """Returns the stream option matching a batch format policy, or None."""
+    if policy == "audio":
+        return next((stream for stream in streams if stream['type'] == 'audio'), None)
+
+    max_height = int(policy)
+    candidates = []
+    for stream in streams:
+        if stream['type'] != 'video':
+            continue
+        try:
+            height = int(stream['resolution'].rstrip('p'))
+        except ValueError:
+            continue
+        if height <= max_height:
+            candidates.append((height, stream))
+    return max(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+
+async def show_batch_policy_selection(update: Update, context: CallbackContext, urls: list, message) -> None:
+    """Разворачивает плейлисты и предлагает один формат для всех видео."""
+    try:
+        video_urls = await asyncio.to_thread(expand_video_urls, urls, BATCH_MAX_ITEMS)
+
+        if not video_urls:
+            await message.edit_text("Не удалось найти видео по этим ссылкам.")
+            return
+        if len(video_urls) == 1:
+            await show_format_selection(update, context, video_urls[0], message)
+            return
+
+        selection_key = selection_store.add({"urls": video_urls})
+        keyboard = [
+            [InlineKeyboardButton(text, callback_data=f"batch_policy:{selection_key}:{policy}")]
+            for policy, text in BATCH_POLICIES.items()
+        ]
+        await message.edit_text(
+            f"Найдено видео: {len(video_urls)}" + (f" (максимум {BATCH_MAX_ITEMS})" if len(video_urls) == BATCH_MAX_ITEMS else "") + ".\n"
+            "Выберите формат для всех видео:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    except Exception as e:
+        logger.error(f"Error in show_batch_policy_selection: {e}", exc_info=True)
+        await message.edit_text(f"Произошла ошибка при получении списка видео: {e}")
+
+
+async def batch_policy_handler(update: Update, context: CallbackContext) -> None:
+    """Обрабатывает выбор формата для пакета видео."""
+    query = update.callback_query
+    await query.answer()
+
+    _, selection_key, policy = query.data.split(":")
+    selection = selection_store.get(selection_key)
+    if not selection or 'urls' not in selection or policy not in BATCH_POLICIES:
+        await query.edit_message_text("❌ Ошибка: выбор устарел. Пожалуйста, отправьте ссылки заново.")
+        return
+
+    await query.edit_message_text(f"🔎 Получаю информацию о видео: 0 из {len(selection['urls'])}...")
+    context.application.create_task(price_batch(update, selection_key, selection, policy, query.message))
+
+
+async def price_batch(update: Update, selection_key: str, selection: dict, policy: str, message) -> None:
+    """Получает форматы всех видео пакета (параллельно, с ограничением) и считает общую стоимость."""
+    urls = selection['urls']
+    semaphore = asyncio.Semaphore(BATCH_METADATA_CONCURRENCY)
+    progress = {"resolved": 0, "shown": time.monotonic()}
+
+    async def resolve(url):
+        stream = None
+        async with semaphore:
+            try:
+                video_id = extract_video_id(url)
+                cached_key = selection_store.find(video_id) if video_id else None
+                if cached_key:
+                    streams = list(selection_store.get(cached_key)['streams'].values())
+                else:
+                    streams, title = await asyncio.to_thread(get_video_streams, url)
+                    if streams:
+                        selection_store.put(url, title, price_streams(streams), video_id)
+                stream = pick_stream(streams, policy)
+            except Exception as e:
+                logger.warning(f"Failed to get streams for batch item {url}: {e}")
+
+        progress["resolved"] += 1
+        # Telegram ограничивает частоту редактирования сообщений
+        if time.monotonic() - progress["shown"] > 2:
+            progress["shown"] = time.monotonic()
+            try:
+                await message.edit_text(f"🔎 Получаю информацию о видео: {progress['resolved']} из {len(urls)}...")
+            except BadRequest:
+                pass
+
+        if not stream:
+            return None
+        return {
+            'url': url,
+            'itag': stream['itag'],
+            'filesize': stream.get('filesize', 0),
+            'type': stream['type'],
+            'streamable': is_streamable(stream),
+            'cost': stream['cost'],
+        }
+
+    try:
+        items = [item for item in await asyncio.gather(*(resolve(url) for url in urls)) if item]
+        if not items:
+            await message.edit_text("Не удалось найти подходящий формат ни для одного видео.")
+            return
+
+        selection['policy'] = policy
+        selection['items'] = items
+        selection['cost'] = sum(item['cost'] for item in items)
+
+        total_mb = sum(item['filesize'] for item in items) / 1_048_576
+        skipped = len(urls) - len(items)
+        balance = get_balance(update.effective_user.id)
+        keyboard = [
+            [
+                InlineKeyboardButton("✅ Подтвердить", callback_data=f"batch_confirm:{selection_key}"),
+                InlineKeyboardButton("❌ Отмена", callback_data=f"batch_cancel:{selection_key}"),
+            ]
+        ]
+        await message.edit_text(
+            f"📦 Видео: {len(items)} ({BATCH_POLICIES[policy]}), всего ≈{total_mb:.1f} MB.\n"
+            + (f"Пропущено (нет подходящего формата): {skipped}.\n" if skipped else "")
+            + f"Стоимость: {selection['cost']} кредитов. Ваш баланс: {balance} кредитов.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    except Exception as e:
+        logger.error(f"Error in price_batch: {e}", exc_info=True)
+        await message.edit_text(f"Произошла ошибка при получении информации о видео: {e}")
+
+
+async def process_batch_confirmation(update: Update, context: CallbackContext) -> None:
+    """Обрабатывает подтверждение или отмену пакетной загрузки."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    try:
+        action, selection_key = query.data.split(":")
+        selection = selection_store.get(selection_key)
+        if not selection or 'items' not in selection:
+            await query.edit_message_text("❌ Ошибка: выбор устарел. Пожалуйста, отправьте ссылки заново.")
+            return
+
+        if action == "batch_cancel":
+            selection_store.pop(selection_key)
+            await query.edit_message_text("❌ Пакетная загрузка отменена.")
+            return
+
+        items, cost = selection['items'], selection['cost']
+        current_balance = get_balance(user_id)
+        if current_balance < cost:
+            await query.edit_message_text(
+                f"❌ Недостаточно кредитов. Ваш баланс: {current_balance}, стоимость: {cost}."
+            )
+            return
+
+        accepted, backlog = check_admission(context, sum(item['filesize'] for item in items), 'batch', items)
+        if not accepted:
+            await query.edit_message_text(
+                f"⚠️ Бот сейчас перегружен: ожидание в очереди {format_eta(backlog)}.\n"
+                "Кредиты не списаны, попробуйте позже."
+            )
+            return
+
+        if not update_balance(user_id, cost):
+            await query.edit_message_text("❌ Ошибка при списании кредитов. Попробуйте снова.")
+            return
+        selection_store.pop(selection_key)
+
+        queue_len, start_in, finish_in = add_batch_to_queue(
+            context, query.message.chat_id, query.message.message_id, user_id, items,
+            BATCH_POLICIES[selection['policy']]
+        )
+
+        new_balance = get_balance(user_id)
+        await query.edit_message_text(
+            f"✅ Пакет из {len(items)} видео добавлен в очередь. Место: {queue_len}\n"
+            f"Начало ≈ через {format_eta(start_in)}, готово ≈ через {format_eta(finish_in)}\n"
+            f"Списано {cost} кредитов. Новый баланс: {new_balance}."
+        )
+
+    except Exception as e:
+        logger.exception(f"Error in process_batch_confirmation for query data: {query.data}")
+        await query.edit_message_text(f"❌ Произошла ошибка при обработке вашего выбора: {e}")
 
 
 async def ask_for_confirmation(update: Update, context: CallbackContext) -> None:
@@ -244,19 +519,23 @@ async def ask_for_confirmation(update: Update, context: CallbackContext) -> None
     await query.answer()
 
     try:
-        _, itag_str, cost_str, url_key = query.data.split(":", 3)
-        cost = int(cost_str)
+        _, selection_key, itag_str = query.data.split(":")
+        selection = selection_store.get(selection_key)
+        stream = selection['streams'].get(int(itag_str)) if selection else None
+        if not stream:
+            await query.edit_message_text("❌ Ошибка: выбор устарел. Пожалуйста, отправьте ссылку заново.")
+            return
         
         keyboard = [
             [
-                InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm:{itag_str}:{cost_str}:{url_key}"),
-                InlineKeyboardButton("❌ Отмена", callback_data=f"cancel:0:0:{url_key}"),
+                InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm:{selection_key}:{itag_str}"),
+                InlineKeyboardButton("❌ Отмена", callback_data=f"cancel:{selection_key}"),
             ]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
-            f"С вашего баланса будет списано {cost} кредитов. Подтверждаете?",
+            f"С вашего баланса будет списано {stream['cost']} кредитов. Подтверждаете?",
             reply_markup=reply_markup
         )
 
@@ -272,23 +551,30 @@ async def process_confirmation(update: Update, context: CallbackContext) -> None
     await query.answer()
 
     try:
-        action, itag_str, cost_str, url_key = query.data.split(":")
+        action, selection_key, *rest = query.data.split(":")
         
         if action == "cancel":
-            url = context.user_data.get(url_key)
-            if not url:
-                await query.edit_message_text("❌ Ошибка: URL видео не найден. Пожалуйста, отправьте ссылку заново.")
+            selection = selection_store.get(selection_key)
+            if not selection:
+                await query.edit_message_text("❌ Ошибка: выбор устарел. Пожалуйста, отправьте ссылку заново.")
                 return
-            await show_format_selection(update, context, url, query.message)
+            await render_format_menu(update, selection_key, selection, query.message)
             return
 
         if action == "confirm":
-            itag = int(itag_str)
-            cost = int(cost_str)
+            itag = int(rest[0])
             
-            url = context.user_data.get(url_key)
-            if not url:
-                await query.edit_message_text("❌ Ошибка: URL видео не найден. Пожалуйста, отправьте ссылку заново.")
+            selection = selection_store.get(selection_key)
+            stream = selection['streams'].get(itag) if selection else None
+            if not stream:
+                await query.edit_message_text("❌ Ошибка: выбор устарел. Пожалуйста, отправьте ссылку заново.")
+                return
+            cost = stream['cost']
+
+            # Повторное нажатие "Подтвердить" в том же сообщении не должно списать кредиты дважды
+            confirmed_messages = context.user_data.setdefault('confirmed_messages', deque(maxlen=CONFIRMED_MESSAGES_KEPT))
+            if query.message.message_id in confirmed_messages:
+                await query.edit_message_text("ℹ️ Эта заявка уже в очереди. Кредиты повторно не списаны.")
                 return
 
             current_balance = get_balance(user_id)
@@ -298,58 +584,118 @@ async def process_confirmation(update: Update, context: CallbackContext) -> None
                 )
                 return
 
+            accepted, backlog = check_admission(
+                context, stream.get('filesize', 0), stream['type'], streamable=is_streamable(stream)
+            )
+            if not accepted:
+                await query.edit_message_text(
+                    f"⚠️ Бот сейчас перегружен: ожидание в очереди {format_eta(backlog)}.\n"
+                    "Кредиты не списаны, попробуйте позже."
+                )
+                return
+
             if not update_balance(user_id, cost):
                 await query.edit_message_text("❌ Ошибка при списании кредитов. Попробуйте снова.")
                 return
+            confirmed_messages.append(query.message.message_id)
 
-            streams, _ = get_video_streams(url)
-            selected_format_text = "неизвестный формат"
-            for stream_info in streams:
-                if stream_info['itag'] == itag:
-                    filesize_mb = stream_info.get('filesize', 0) / 1_048_576
-                    if stream_info['type'] == 'video':
-                        selected_format_text = f"📹 {stream_info['resolution']} | {filesize_mb:.1f} MB"
-                    else:
-                        selected_format_text = f"🎵 {stream_info['abr']} | {filesize_mb:.1f} MB"
-                    break
-            
-            queue_len = add_to_queue(context, query.message.chat_id, query.message.message_id, url, itag, selected_format_text)
+            selected_format_text = f"{stream_label(stream)} | {stream_size_text(stream)}"
+            queue_len, start_in, finish_in = add_to_queue(
+                context, query.message.chat_id, query.message.message_id, selection['url'], itag,
+                selected_format_text, stream.get('filesize', 0), stream['type'], is_streamable(stream)
+            )
 
             new_balance = get_balance(user_id)
             await query.edit_message_text(
                 f"✅ Заявка добавлена в очередь. Место: {queue_len}\n"
+                f"Начало ≈ через {format_eta(start_in)}, готово ≈ через {format_eta(finish_in)}\n"
                 f"Списано {cost} кредитов. Новый баланс: {new_balance}."
             )
 
-            if url_key in context.user_data:
-                del context.user_data[url_key]
-
     except Exception as e:
         logger.exception(f"Error in process_confirmation for query data: {query.data}")
         await query.edit_message_text(f"❌ Произошла ошибка при обработке вашего выбора: {e}")
 
 
-async def post_init(application: Application) -> None:
-    """Post initialization hook for the bot."""
-    await application.bot.set_my_commands([
+async def set_bot_commands(application: Application) -> None:
+    """Sets the command menu for everyone and, concurrently, for each admin."""
+    user_commands = [
         BotCommand("start", "Запустить бота"),
         BotCommand("balance", "Проверить баланс"),
         BotCommand("topup", "Пополнить баланс"),
-    ])
-    # Add admin commands separately
-    for admin_id in ADMIN_USER_IDS:
+    ]
+    admin_commands = user_commands + [BotCommand("addcredits", "Добавить кредиты пользователю")]
+
+    async def set_admin_commands(admin_id: int) -> None:
         try:
-            await application.bot.set_my_commands([
-                BotCommand("start", "Запустить бота"),
-                BotCommand("balance", "Проверить баланс"),
-                BotCommand("topup", "Пополнить баланс"),
-                BotCommand("addcredits", "Добавить кредиты пользователю"),
-            ], scope={"type": "chat", "chat_id": admin_id})
+            await application.bot.set_my_commands(admin_commands, scope={"type": "chat", "chat_id": admin_id})
         except BadRequest as e:
             logger.error(f"Failed to set commands for admin {admin_id}: {e}")
 
+    try:
+        await asyncio.gather(
+            application.bot.set_my_commands(user_commands),
+            *(set_admin_commands(admin_id) for admin_id in ADMIN_USER_IDS),
+        )
+    except Exception as e:
+        logger.error(f"Failed to set bot commands: {e}")
+
+
+async def balance_cache_checker() -> None:
+    """Periodically reconciles the in-memory balance cache with the database."""
+    while True:
+        await asyncio.sleep(BALANCE_CACHE_CHECK_INTERVAL)
+        try:
+            mismatches = await asyncio.to_thread(verify_balance_cache)
+            if mismatches:
+                logger.warning(f"Fixed {mismatches} stale balance cache entries")
+        except Exception:
+            logger.exception("Balance cache check failed")
+
+
+def start_background_task(application: Application, coroutine, name: str) -> None:
+    """
+    Starts a task via application.create_task (so its errors reach PTB's error
+    handling) and keeps a reference to it in bot_data until it finishes.
+    """
+    with warnings.catch_warnings():
+        # post_init runs before the application is marked as running, so PTB does not
+        # track these tasks itself; they are tracked here and cancelled in post_shutdown
+        warnings.filterwarnings("ignore", message="Tasks created via `Application.create_task`")
+        task = application.create_task(coroutine, name=name)
+    tasks = application.bot_data['background_tasks']
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+async def post_init(application: Application) -> None:
+    """Post initialization hook for the bot."""
     application.bot_data['download_queue'] = deque()
-    asyncio.create_task(queue_processor(application))
+    application.bot_data['current_job'] = None
+    application.bot_data['background_tasks'] = set()
+    start_background_task(application, queue_processor(application), "queue_processor")
+    if cryptopay:
+        start_background_task(application, crypto_invoice_poller(application, cryptopay), "crypto_invoice_poller")
+    start_background_task(application, balance_cache_checker(), "balance_cache_checker")
+
+    # Не задерживаем начало приёма обновлений: команды и тяжёлые импорты — в фоне
+    start_background_task(application, set_bot_commands(application), "set_bot_commands")
+    start_background_task(application, asyncio.to_thread(importlib.import_module, "pytubefix"), "import_pytubefix")
+
+    mark_startup_phase("post_init")
+    logger.info(
+        "Startup phases: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in STARTUP_PHASES.items())
+        + f" (total {sum(STARTUP_PHASES.values()):.0f} ms)"
+    )
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stops background tasks and releases pooled HTTP connections on shutdown."""
+    tasks = list(application.bot_data.get('background_tasks', ()))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_http_client()
 
 
 def main() -> None:
@@ -358,7 +704,11 @@ def main() -> None:
         logger.error("Ошибка: Токен TELEGRAM_BOT_TOKEN не найден в .env файле.")
         return
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).base_url("http://telegram-bot-api:8081/bot").base_file_url("http://telegram-bot-api:8081/file/bot").build()
+    init_db()
+    DOWNLOAD_DIR.mkdir(exist_ok=True)
+    mark_startup_phase("init")
+
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).base_url("http://telegram-bot-api:8081/bot").base_file_url("http://telegram-bot-api:8081/file/bot").build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("balance", balance_command))
@@ -368,17 +718,20 @@ def main() -> None:
     
     # Обработчики для скачивания
     application.add_handler(CallbackQueryHandler(ask_for_confirmation, pattern="^select:"))
-    application.add_handler(CallbackQueryHandler(process_confirmation, pattern="^(confirm|cancel):\d+:\d+:[0-9a-fA-F-]+"))
+    application.add_handler(CallbackQueryHandler(process_confirmation, pattern="^(confirm|cancel):"))
+    application.add_handler(CallbackQueryHandler(batch_policy_handler, pattern="^batch_policy:"))
+    application.add_handler(CallbackQueryHandler(process_batch_confirmation, pattern="^batch_(confirm|cancel):"))
 
     # Обработчики для пополнения
     application.add_handler(CallbackQueryHandler(topup_button_handler, pattern="^topup$"))
     application.add_handler(CallbackQueryHandler(select_topup_method_handler, pattern="^topup_method:"))
     application.add_handler(CallbackQueryHandler(select_stars_package_handler, pattern="^topup_stars:"))
-    application.add_handler(CallbackQueryHandler(lambda update, context: check_crypto_payment_handler(update, context, cryptopay), pattern="^check_crypto_payment:"))
+    application.add_handler(CallbackQueryHandler(check_crypto_payment_handler, pattern="^check_crypto_payment:"))
     application.add_handler(CallbackQueryHandler(back_to_topup_method_handler, pattern="^back_to_topup_method$"))
     application.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
 
+    mark_startup_phase("build")
     logger.info("Бот запущен...")
     application.run_polling()
 
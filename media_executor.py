@@ -0,0 +1,152 @@
+import os
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def _available_cpus() -> int:
+    """Returns the number of CPUs this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+# waitid(WNOWAIT) + wait4 give ffmpeg's CPU time; they are missing on Windows and on macOS before Python 3.13
+_CAN_REAP_WITH_RUSAGE = hasattr(os, "waitid") and hasattr(os, "WNOWAIT") and hasattr(os, "wait4")
+
+# Настраиваемые параметры (можно переопределить через переменные окружения)
+FFMPEG_MAX_CONCURRENCY = int(os.getenv("FFMPEG_MAX_CONCURRENCY", "0")) or max(1, _available_cpus() // 2)
+FFMPEG_NICENESS = int(os.getenv("FFMPEG_NICENESS", "10"))
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", "1800"))  # seconds
+
+
+class MediaExecutor:
+    """
+    Runs ffmpeg jobs with a concurrency cap, lowered CPU priority and a
+    per-process timeout, so that merges never starve the bot's event loop.
+    Blocking: call it from a worker thread (e.g. via asyncio.to_thread).
+    """
+
+    def __init__(self, max_concurrency: int = FFMPEG_MAX_CONCURRENCY,
+                 niceness: int = FFMPEG_NICENESS, timeout: int = FFMPEG_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.niceness = niceness
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def run_ffmpeg(self, args: list, timeout: int = None) -> dict:
+        """
+        Runs `ffmpeg <args>` and returns job stats (wall time and CPU time).
+        Raises RuntimeError if ffmpeg is missing, fails or times out.
+        """
+        timeout = timeout or self.timeout
+        command = [
+            *self._nice_prefix(),
+            'ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-progress', 'pipe:2', *args
+        ]
+
+        with self._slots:
+            started = time.monotonic()
+            try:
+                proc = subprocess.Popen(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    errors="replace",
+                )
+            except FileNotFoundError:
+                raise RuntimeError("ffmpeg not found. Please install ffmpeg and ensure it's in your PATH.")
+
+            timed_out = threading.Event()
+            # Reaping and killing are serialized, so the timer never signals a pid that was already reaped
+            reap_lock = threading.Lock()
+
+            def _kill():
+                with reap_lock:
+                    if proc.returncode is None:
+                        timed_out.set()
+                        proc.kill()
+
+            timer = threading.Timer(timeout, _kill)
+            timer.daemon = True
+            timer.start()
+            try:
+                errors = self._stream_stderr(proc)
+                rusage = self._reap(proc, reap_lock)
+            finally:
+                timer.cancel()
+                proc.stderr.close()
+
+        stats = {
+            "wall_time": time.monotonic() - started,
+            "cpu_time": rusage.ru_utime + rusage.ru_stime if rusage else None,  # None where rusage is unavailable
+        }
+
+        if timed_out.is_set():
+            raise RuntimeError(f"ffmpeg timed out after {timeout} s.")
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {proc.returncode}. STDERR: {' '.join(errors)}")
+
+        cpu_time = f"{stats['cpu_time']:.1f} s" if stats['cpu_time'] is not None else "n/a"
+        logger.info(f"ffmpeg finished in {stats['wall_time']:.1f} s (CPU time {cpu_time}).")
+        return stats
+
+    @staticmethod
+    def _reap(proc, reap_lock):
+        """Waits for ffmpeg to exit and returns its rusage, or None where the platform cannot report it."""
+        if _CAN_REAP_WITH_RUSAGE:
+            # Wait for the exit without reaping, so the timeout still applies, then reap with rusage
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            with reap_lock:
+                _, status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+            return rusage
+
+        # No waitid/wait4 (Windows, macOS before Python 3.13): let Popen reap the process,
+        # waiting in short steps so the timeout can take the lock in between
+        while True:
+            with reap_lock:
+                try:
+                    proc.wait(timeout=0.5)
+                    return None
+                except subprocess.TimeoutExpired:
+                    pass
+
+    def _nice_prefix(self) -> list:
+        """
+        Returns the `nice` command prefix, so that ffmpeg starts with lowered
+        priority (renicing it after start would miss threads it already created).
+        """
+        if not self.niceness:
+            return []
+        if not shutil.which("nice"):
+            logger.warning("nice not found, ffmpeg runs with normal priority.")
+            return []
+        return ['nice', '-n', str(self.niceness)]
+
+    @staticmethod
+    def _stream_stderr(proc) -> list:
+        """Logs ffmpeg progress as it arrives and returns the last error lines."""
+        errors = deque(maxlen=20)
+        progress = {}
+        for line in proc.stderr:
+            key, sep, value = line.strip().partition("=")
+            if not sep or " " in key:
+                if line.strip():
+                    errors.append(line.strip())
+                continue
+            progress[key] = value
+            if key == "progress":
+                logger.info(f"ffmpeg: time={progress.get('out_time', '?')} size={progress.get('total_size', '?')} speed={progress.get('speed', '?')}")
+        return list(errors)
+
+
+media_executor = MediaExecutor()
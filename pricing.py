@@ -0,0 +1,123 @@
+import os
+import json
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Путь к JSON с тарифами; отсутствующие в нём ключи берутся из DEFAULT_PRICING
+PRICING_CONFIG = os.getenv("PRICING_CONFIG", "pricing.json")
+
+DEFAULT_PRICING = {
+    # Разрешения по порядку качества
+    "resolution_order": ["144p", "240p", "360p", "480p", "720p", "1080p", "1440p", "4K", "8K"],
+    "video": {
+        "base_cost_by_resolution": {
+            "480p": 1,
+            "720p": 3,
+            "1080p": 6,
+            "1440p": 9,
+            "4K": 12,
+        },
+        # Цена для разрешений не выше "low_resolution", которых нет в base_cost_by_resolution
+        "low_resolution": "480p",
+        "low_resolution_cost": 1,
+        # Максимальное качество и размер, при которых видео можно скачать бесплатно
+        "max_free_filesize_mb": 100,
+        "max_free_resolution": "720p",
+        # [размер до (MB), множитель]; чем больше файл — тем дороже
+        "size_multipliers": [[50, 1], [200, 2], [500, 3], [1024, 4], [2048, 5]],
+        "max_multiplier": 10,
+    },
+    "audio": {
+        # Один кредит за каждые начатые mb_per_credit мегабайт
+        "mb_per_credit": 50,
+        "min_cost": 1,
+    },
+}
+
+
+class PricingTable:
+    """
+    Pricing rules compiled into lookup tables once, so that pricing a stream
+    is a couple of dict/list lookups instead of rebuilding the rules per call.
+    """
+
+    def __init__(self, config: dict):
+        order = config["resolution_order"]
+        rank = {resolution: i for i, resolution in enumerate(order)}
+        video = config["video"]
+        base_costs = video["base_cost_by_resolution"]
+        max_base_cost = max(base_costs.values())
+
+        def rank_leq(r1, r2):
+            return r1 in rank and r2 in rank and rank[r1] <= rank[r2]
+
+        # Base cost for every known resolution; unknown resolutions cost the maximum
+        self._max_base_cost = max_base_cost
+        self._base_cost = {}
+        for resolution in order:
+            if resolution in base_costs:
+                self._base_cost[resolution] = base_costs[resolution]
+            elif rank_leq(resolution, video["low_resolution"]):
+                self._base_cost[resolution] = video["low_resolution_cost"]
+            else:
+                self._base_cost[resolution] = max_base_cost
+        self._base_cost.update(base_costs)
+
+        self._free_resolutions = frozenset(r for r in order if rank_leq(r, video["max_free_resolution"]))
+        self._max_free_filesize_mb = video["max_free_filesize_mb"]
+
+        # Multiplier for every whole megabyte up to the last threshold
+        self._multipliers = []
+        for limit_mb, multiplier in sorted(video["size_multipliers"]):
+            self._multipliers.extend([multiplier] * (limit_mb + 1 - len(self._multipliers)))
+        self._max_multiplier = video["max_multiplier"]
+
+        audio = config["audio"]
+        self._mb_per_credit = audio["mb_per_credit"]
+        self._audio_min_cost = audio["min_cost"]
+
+    def video_cost(self, resolution: str, filesize_mb: int) -> int:
+        # Проверка на бесплатность
+        if filesize_mb <= self._max_free_filesize_mb and resolution in self._free_resolutions:
+            return 0
+
+        base_cost = self._base_cost.get(resolution, self._max_base_cost)
+        if filesize_mb < len(self._multipliers):
+            multiplier = self._multipliers[max(0, filesize_mb)]
+        else:
+            multiplier = self._max_multiplier
+        return round(base_cost * multiplier)
+
+    def audio_cost(self, filesize_mb: float) -> int:
+        return max(self._audio_min_cost, int(filesize_mb // self._mb_per_credit) + 1)
+
+
+def load_pricing(path=PRICING_CONFIG) -> PricingTable:
+    """Loads pricing from a JSON file (if present) on top of the defaults and compiles it."""
+    config = {
+        "resolution_order": DEFAULT_PRICING["resolution_order"],
+        "video": dict(DEFAULT_PRICING["video"]),
+        "audio": dict(DEFAULT_PRICING["audio"]),
+    }
+    path = Path(path)
+    if path.exists():
+        with open(path, encoding="utf-8") as fh:
+            overrides = json.load(fh)
+        config["resolution_order"] = overrides.get("resolution_order", config["resolution_order"])
+        config["video"].update(overrides.get("video", {}))
+        config["audio"].update(overrides.get("audio", {}))
+        logger.info(f"Loaded pricing from {path}")
+    return PricingTable(config)
+
+
+pricing_table = load_pricing()
+
+
+def calculate_video_cost(resolution: str, filesize_mb: int) -> int:
+    return pricing_table.video_cost(resolution, filesize_mb)
+
+
+def calculate_audio_cost(filesize_mb: float) -> int:
+    return pricing_table.audio_cost(filesize_mb)
@@ -1,28 +1,233 @@
 import asyncio
 import logging
 import os
+import shutil
+import tempfile
+import time
 from pathlib import Path
 
-from telegram import InputFile
 from telegram.ext import Application
 
-from yt_downloader import process_youtube_url
+from yt_downloader import resolve_youtube_url, download_video, can_stream, open_stream
+from balance import add_balance
+from bandwidth import bandwidth_governor
+from telegram_upload import send_document_stream, iter_file
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_DIR = Path("downloads")
+
+# Отправлять аудио и progressive-видео в Telegram по мере скачивания, минуя диск
+STREAM_DELIVERY = os.getenv("STREAM_DELIVERY", "1") == "1"
+
+# Контроль нагрузки: новые заявки отклоняются до списания кредитов
+MAX_QUEUE_JOBS = int(os.getenv("MAX_QUEUE_JOBS", "100"))
+MAX_QUEUE_WAIT = int(os.getenv("MAX_QUEUE_WAIT", "3600"))  # seconds of estimated backlog
+
+# Сколько видео из пакета обрабатываются одновременно
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+
+
+class ThroughputStats:
+    """
+    Rolling (exponentially weighted) throughput per processing stage,
+    in units per second. Stages without observations use a default rate.
+    """
+
+    DEFAULT_RATES = {
+        "resolve": 1 / 5,  # jobs per second (metadata resolution)
+        "download": 5 * 1024 * 1024,  # bytes per second, including the ffmpeg merge
+        "upload": 10 * 1024 * 1024,
+        "stream": 5 * 1024 * 1024,  # diskless download + upload
+    }
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self._rates = dict(self.DEFAULT_RATES)
+
+    def record(self, stage: str, amount: float, seconds: float) -> None:
+        if amount <= 0 or seconds <= 0:
+            return
+        observed = amount / seconds
+        self._rates[stage] = self.alpha * observed + (1 - self.alpha) * self._rates[stage]
+
+    def seconds_for(self, stage: str, amount: float) -> float:
+        return amount / self._rates[stage]
+
+
+throughput_stats = ThroughputStats()
+
+
+def is_streamable(stream: dict) -> bool:
+    """Whether a stream option is delivered without disk: audio and progressive video (see can_stream)."""
+    return STREAM_DELIVERY and (stream['type'] == 'audio' or bool(stream.get('progressive')))
+
+
+def estimate_job_seconds(job: dict) -> float:
+    """Estimates how long a job takes from its size and the observed throughput."""
+    if job.get('items'):
+        # Batch items share the link, so together they take about as long as back-to-back jobs
+        return sum(estimate_job_seconds(item) for item in job['items'])
+    size = job['filesize']
+    seconds = throughput_stats.seconds_for("resolve", 1)
+    if job.get('streamable'):
+        return seconds + throughput_stats.seconds_for("stream", size)
+    return seconds + throughput_stats.seconds_for("download", size) + throughput_stats.seconds_for("upload", size)
+
+
+def _current_job_remaining(bot_data) -> float:
+    current_job = bot_data.get('current_job')
+    if not current_job:
+        return 0.0
+    return max(0.0, current_job['estimate'] - (time.monotonic() - current_job['started']))
+
+
+def estimate_queue_times(bot_data) -> list:
+    """Returns (start_in, finish_in) in seconds for every job waiting in the queue."""
+    elapsed_until = _current_job_remaining(bot_data)
+    times = []
+    for job in bot_data['download_queue']:
+        start_in = elapsed_until
+        elapsed_until += estimate_job_seconds(job)
+        times.append((start_in, elapsed_until))
+    return times
+
+
+def format_eta(seconds: float) -> str:
+    """Formats a duration for users, e.g. "~5 мин"."""
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "< 1 мин"
+    if minutes < 60:
+        return f"~{minutes} мин"
+    return f"~{minutes // 60} ч {minutes % 60} мин"
+
+
+def queue_status_text(position: int, start_in: float, finish_in: float) -> str:
+    return (
+        f"⏳ Ваше место в очереди: {position}\n"
+        f"Начало ≈ через {format_eta(start_in)}, готово ≈ через {format_eta(finish_in)}"
+    )
+
 
 async def update_queue_messages(application: Application):
     """Updates all messages for users waiting in the queue."""
     queue = application.bot_data['download_queue']
-    for i, (chat_id, message_id, _, _, _) in enumerate(queue):
+    times = estimate_queue_times(application.bot_data)
+    for i, (job, (start_in, finish_in)) in enumerate(zip(list(queue), times)):
+        try:
+            await application.bot.edit_message_text(
+                chat_id=job['chat_id'],
+                message_id=job['message_id'],
+                text=queue_status_text(i + 1, start_in, finish_in)
+            )
+        except Exception as e:
+            logger.warning(f"Failed to update queue message for chat {job['chat_id']}: {e}")
+
+
+class DeliveryError(Exception):
+    """A delivery failure whose message is shown to the user as is."""
+
+
+async def deliver_video(application: Application, chat_id: int, url: str, itag: int,
+                        set_status=None, record_stats: bool = True) -> None:
+    """
+    Downloads one video and sends it to the chat. `set_status` is an optional
+    coroutine function used to report progress to the user.
+    """
+    work_dir = None
+    try:
+        stage_started = time.monotonic()
+        plan = await resolve_youtube_url(url, itag)
+        if record_stats:
+            throughput_stats.record("resolve", 1, time.monotonic() - stage_started)
+
+        streaming = STREAM_DELIVERY and can_stream(plan)
+        if streaming:
+            # Audio-only and progressive streams go straight from YouTube to Telegram
+            file_size = plan["parts"][0]["filesize"]
+            filename = plan["filename"]
+            chunks = open_stream(plan, user_id=chat_id)
+        else:
+            stage_started = time.monotonic()
+            # Each delivery gets its own directory: batch items run concurrently
+            # and videos with the same title would otherwise overwrite each other
+            DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+            work_dir = Path(tempfile.mkdtemp(dir=DOWNLOAD_DIR))
+            output_path = await download_video(plan, work_dir, user_id=chat_id)
+
+            if not output_path or not Path(output_path).exists():
+                raise DeliveryError("❌ Не удалось скачать видео.")
+
+            file_size = os.path.getsize(output_path)
+            if record_stats:
+                throughput_stats.record("download", file_size, time.monotonic() - stage_started)
+            filename = Path(output_path).name
+            chunks = iter_file(output_path)
+
+        if file_size > 2 * 1024 * 1024 * 1024:
+            raise DeliveryError("❌ Ошибка: Файл слишком большой для отправки через Telegram (больше 2 ГБ).")
+
+        safe_name = filename.encode('utf-8', 'ignore').decode('utf-8')
+        if set_status:
+            await set_status("⬆️ Отправляю видео...")
+
+        stage_started = time.monotonic()
+        await send_document_stream(
+            application.bot, chat_id, safe_name, chunks, file_size, user_id=chat_id
+        )
+        if record_stats:
+            throughput_stats.record("stream" if streaming else "upload", file_size, time.monotonic() - stage_started)
+
+    finally:
+        if work_dir:
+            try:
+                shutil.rmtree(work_dir)
+            except Exception:
+                logger.warning("Temp dir remove failed", exc_info=True)
+
+
+async def process_batch(application: Application, job: dict) -> None:
+    """
+    Delivers every video of a batch job with bounded concurrency, so that
+    metadata resolution of the next videos overlaps with transfers of the
+    current ones. Progress is shown in one message; failed videos are refunded.
+    """
+    chat_id, message_id, items = job['chat_id'], job['message_id'], job['items']
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    progress = {"done": 0, "failed": 0, "refund": 0}
+
+    async def show_progress():
         try:
             await application.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=message_id,
-                text=f"⏳ Ваше место в очереди: {i + 1}"
+                text=f"📦 Пакет ({job['format_text']}): готово {progress['done']} из {len(items)}"
+                     + (f", ошибок: {progress['failed']}" if progress['failed'] else "")
             )
         except Exception as e:
-            logger.warning(f"Failed to update queue message for chat {chat_id}: {e}")
+            logger.warning(f"Failed to update batch progress for chat {chat_id}: {e}")
+
+    async def run(item):
+        async with semaphore:
+            try:
+                # Per-transfer rates are skewed while batch items share the link, so they are not recorded
+                await deliver_video(application, chat_id, item['url'], item['itag'], record_stats=False)
+                progress["done"] += 1
+            except Exception:
+                logger.exception(f"Error processing batch item {item['url']} for chat {chat_id}")
+                progress["failed"] += 1
+                progress["refund"] += item['cost']
+        await show_progress()
+
+    await show_progress()
+    await asyncio.gather(*(run(item) for item in items))
+
+    text = f"✅ Пакет завершён: скачано {progress['done']} из {len(items)} видео."
+    if progress["refund"]:
+        add_balance(job['user_id'], progress["refund"])
+        text += f"\nЗа {progress['failed']} неудачных видео возвращено {progress['refund']} кредитов."
+    await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
 
 
 async def queue_processor(application: Application):
@@ -35,66 +240,95 @@ async def queue_processor(application: Application):
             continue
 
         # Get the next job
-        chat_id, message_id, url, itag, selected_format_text = queue.popleft()
-        output_path = None
+        job = queue.popleft()
+        chat_id, message_id, selected_format_text = job['chat_id'], job['message_id'], job['format_text']
+        job['started'] = time.monotonic()
+        job['estimate'] = estimate_job_seconds(job)
+        application.bot_data['current_job'] = job
+
+        async def set_status(text):
+            await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
 
         try:
-            await application.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=f"⏳ Начинаю скачивание ({selected_format_text})... Это может занять некоторое время."
-            )
+            # Chats here are private, so the chat ID identifies the user
+            with bandwidth_governor.job(chat_id):
+                if job['type'] == 'batch':
+                    await update_queue_messages(application)
+                    await process_batch(application, job)
+                    continue
 
-            # Update queue for everyone else
-            await update_queue_messages(application)
+                await set_status(f"⏳ Начинаю скачивание ({selected_format_text})... Это может занять некоторое время.")
 
-            output_path = await asyncio.to_thread(process_youtube_url, url, Path("downloads"), itag)
+                # Update queue for everyone else
+                await update_queue_messages(application)
 
-            if not output_path or not Path(output_path).exists():
-                await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="❌ Не удалось скачать видео.")
-                continue
+                await deliver_video(application, chat_id, job['url'], job['itag'], set_status=set_status)
 
-            file_size = os.path.getsize(output_path)
-            if file_size > 2 * 1024 * 1024 * 1024:
-                await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="❌ Ошибка: Файл слишком большой для отправки через Telegram (больше 2 ГБ).")
-                continue
-
-            safe_name = Path(output_path).name.encode('utf-8', 'ignore').decode('utf-8')
-            await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="⬆️ Отправляю видео...")
-
-            with open(output_path, "rb") as fh:
-                video_if = InputFile(fh, filename=safe_name)
-                await application.bot.send_document(
-                    chat_id=chat_id,
-                    document=video_if,
-                    read_timeout=3600,
-                    write_timeout=3600,
-                    connect_timeout=3600,
-                )
-            
-            await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"✅ Готово! Видео скачано ({selected_format_text}).")
+                await set_status(f"✅ Готово! Видео скачано ({selected_format_text}).")
 
         except Exception as e:
             logger.exception(f"Error processing download for chat {chat_id}")
-            error_message = f"❌ Произошла ошибка: {e}"
+            if isinstance(e, DeliveryError):
+                error_message = str(e)
+            else:
+                error_message = f"❌ Произошла ошибка: {e}"
             if len(error_message) > 400:
                 error_message = error_message[:400] + "..."
             try:
-                await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=error_message)
+                await set_status(error_message)
             except Exception as e2:
                 logger.error(f"Failed to even send error message to chat {chat_id}: {e2}")
 
         finally:
-            if output_path and Path(output_path).exists():
-                try:
-                    os.remove(output_path)
-                except Exception:
-                    logger.warning("Temp file remove failed", exc_info=True)
+            application.bot_data['current_job'] = None
             # Process next item in the queue in the next iteration
             await update_queue_messages(application)
 
 
-def add_to_queue(context, chat_id, message_id, url, itag, selected_format_text):
+def check_admission(context, filesize: int, stream_type: str, items: list = None, streamable: bool = False):
+    """
+    Decides whether a new job may be queued. Returns (accepted, backlog_seconds),
+    where backlog_seconds is the estimated wait including the new job.
+    """
+    queue = context.bot_data['download_queue']
+    times = estimate_queue_times(context.bot_data)
+    backlog = times[-1][1] if times else _current_job_remaining(context.bot_data)
+    backlog += estimate_job_seconds({'filesize': filesize, 'type': stream_type, 'items': items, 'streamable': streamable})
+    accepted = len(queue) < MAX_QUEUE_JOBS and backlog <= MAX_QUEUE_WAIT
+    return accepted, backlog
+
+
+def add_to_queue(context, chat_id, message_id, url, itag, selected_format_text, filesize, stream_type, streamable=False):
+    """Queues a job and returns (position, start_in, finish_in)."""
+    queue = context.bot_data['download_queue']
+    queue.append({
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'url': url,
+        'itag': itag,
+        'format_text': selected_format_text,
+        'filesize': filesize,
+        'type': stream_type,
+        'streamable': streamable,
+    })
+    start_in, finish_in = estimate_queue_times(context.bot_data)[-1]
+    return len(queue), start_in, finish_in
+
+
+def add_batch_to_queue(context, chat_id, message_id, user_id, items, policy_text):
+    """
+    Queues a batch of videos as a single job and returns (position, start_in, finish_in).
+    Each item is a dict with 'url', 'itag', 'filesize', 'type', 'streamable' and 'cost'.
+    """
     queue = context.bot_data['download_queue']
-    queue.append((chat_id, message_id, url, itag, selected_format_text))
-    return len(queue)
+    queue.append({
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'user_id': user_id,
+        'format_text': policy_text,
+        'filesize': sum(item['filesize'] for item in items),
+        'type': 'batch',
+        'items': items,
+    })
+    start_in, finish_in = estimate_queue_times(context.bot_data)[-1]
+    return len(queue), start_in, finish_in
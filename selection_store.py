@@ -0,0 +1,107 @@
+import os
+import time
+import secrets
+from collections import OrderedDict
+
+# Настраиваемые параметры
+SELECTION_STORE_SIZE = int(os.getenv("SELECTION_STORE_SIZE", "10000"))
+SELECTION_TTL = int(os.getenv("SELECTION_TTL", "3600"))  # seconds
+
+
+class SelectionStore:
+    """
+    Server-side storage for format menus waiting for the user's choice.
+    Each entry holds the video URL, its title and the priced stream list
+    (or, for batches, the list of videos), and is addressed by a short key
+    that fits into callback data.
+    The store is bounded: the oldest entries are evicted once it is full,
+    and entries older than the TTL are dropped on access.
+
+    Menus are indexed by video ID, so a video requested again while its
+    entry is alive reuses the stored streams (and the keyboards rendered
+    for them) instead of fetching metadata again; every reuse extends
+    the entry's lifetime.
+    """
+
+    def __init__(self, max_size: int = SELECTION_STORE_SIZE, ttl: int = SELECTION_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_video = {}  # video_id -> key
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, url: str, title: str, streams: list, video_id: str = None) -> str:
+        """Stores a menu and returns its key. Each stream dict must contain 'itag' and 'cost'."""
+        key = self.add({
+            "url": url,
+            "title": title,
+            "video_id": video_id,
+            "streams": {stream['itag']: stream for stream in streams},
+            "keyboards": {},  # balance tier -> rendered keyboard
+        })
+        if video_id:
+            self._by_video[video_id] = key
+        return key
+
+    def find(self, video_id: str):
+        """
+        Returns the key of a live menu for a video, or None.
+        A hit restarts the entry's TTL, so a menu shown to another user
+        does not expire right after it appears.
+        """
+        key = self._by_video.get(video_id)
+        if key is None:
+            return None
+        entry = self.get(key)
+        if entry is None:
+            return None
+        entry["created"] = time.monotonic()
+        self._entries.move_to_end(key)
+        return key
+
+    def add(self, entry: dict) -> str:
+        """Stores an arbitrary entry (e.g. a batch of videos) and returns its key."""
+        self._evict_expired()
+        key = secrets.token_hex(4)
+        while key in self._entries:
+            key = secrets.token_hex(4)
+
+        entry["created"] = time.monotonic()
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+        return key
+
+    def get(self, key: str):
+        """Returns the entry for a key, or None if it is unknown or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["created"] > self.ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def pop(self, key: str):
+        """Removes and returns the entry for a key, or None if it is unknown or expired."""
+        entry = self.get(key)
+        if entry is not None:
+            self._remove(key)
+        return entry
+
+    def _evict_expired(self) -> None:
+        # Entries are kept in insertion order, so expired ones are at the front
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry["created"] <= self.ttl:
+                break
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        video_id = entry.get("video_id")
+        if video_id and self._by_video.get(video_id) == key:
+            del self._by_video[video_id]
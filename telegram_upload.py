@@ -0,0 +1,78 @@
+import uuid
+import asyncio
+import logging
+from contextlib import aclosing
+
+import httpx
+
+from async_downloader import get_http_client
+from bandwidth import bandwidth_governor, EGRESS
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_READ_SIZE = 1024 * 1024  # bytes per file read
+UPLOAD_TIMEOUT = httpx.Timeout(3600, connect=60)
+
+
+async def iter_file(path, chunk_size: int = UPLOAD_READ_SIZE):
+    """Yields the content of a file in chunks, reading in a worker thread so the event loop is not blocked."""
+    with open(path, "rb") as fh:
+        while True:
+            data = await asyncio.to_thread(fh.read, chunk_size)
+            if not data:
+                break
+            yield data
+
+
+async def send_document_stream(bot, chat_id: int, filename: str, chunks, size: int, user_id: int = None) -> dict:
+    """
+    Sends a document to a chat by streaming `size` bytes from the async
+    iterator `chunks` as a multipart sendDocument request.
+
+    python-telegram-bot's InputFile reads the whole file into memory before
+    sending; here every chunk is passed through the bandwidth governor's
+    egress budget as it is written. Returns the sent Message as a dict.
+    """
+    boundary = uuid.uuid4().hex
+    safe_filename = filename.replace('"', "%22").replace("\r", "").replace("\n", "")
+    preamble = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="chat_id"\r\n\r\n'
+        f"{chat_id}\r\n"
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="document"; filename="{safe_filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode("utf-8")
+    epilogue = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    async def body():
+        yield preamble
+        sent = 0
+        async for data in chunks:
+            await bandwidth_governor.throttle(EGRESS, len(data), user_id)
+            sent += len(data)
+            yield data
+        if sent != size:
+            raise RuntimeError(f"Upload size mismatch: expected {size} bytes, got {sent}.")
+        yield epilogue
+
+    # Close both generators as soon as the request ends, so that a failed upload
+    # stops the download behind `chunks` right away instead of on garbage collection
+    async with aclosing(chunks), aclosing(body()) as content:
+        response = await get_http_client().post(
+            f"{bot.base_url}/sendDocument",
+            content=content,
+            headers={
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(preamble) + size + len(epilogue)),
+            },
+            timeout=UPLOAD_TIMEOUT,
+        )
+
+    # The local Bot API server (or a proxy in front of it) may answer with an HTML error page
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        raise RuntimeError(f"Telegram API error: HTTP {response.status_code}")
+    result = response.json()
+    if not response.is_success or not result.get("ok"):
+        raise RuntimeError(f"Telegram API error: HTTP {response.status_code}: {result.get('description', 'no description')}")
+    return result["result"]
@@ -1,7 +1,23 @@
+import os
+import time
+import asyncio
+import logging
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackContext
+from telegram.ext import Application, CallbackContext
+
+from balance import (
+    get_balance, add_crypto_invoice, get_crypto_invoice, get_pending_crypto_invoices,
+    credit_crypto_invoice, expire_crypto_invoice, INVOICE_PAID, INVOICE_EXPIRED,
+)
 
-from balance import add_balance, get_balance
+logger = logging.getLogger(__name__)
+
+# Настраиваемые параметры
+CRYPTO_POLL_INTERVAL = int(os.getenv("CRYPTO_POLL_INTERVAL", "20"))  # seconds between reconciliations
+CRYPTO_POLL_COOLDOWN = 3  # seconds to coalesce "check payment" taps into one API call
+CRYPTO_INVOICE_TTL = int(os.getenv("CRYPTO_INVOICE_TTL", "3600"))  # seconds until an unpaid invoice expires
+CRYPTO_BATCH_SIZE = 1000  # max invoice IDs per get_invoices call
 
 async def handle_crypto_topup(update: Update, context: CallbackContext, cryptopay) -> None:
     """Обрабатывает сумму для пополнения через CryptoBot."""
@@ -12,10 +28,9 @@ async def handle_crypto_topup(update: Update, context: CallbackContext, cryptopa
             return
 
         amount_usd = amount_credits * 0.01
-        invoice = await cryptopay.create_invoice(asset='USDT', amount=amount_usd)
+        invoice = await cryptopay.create_invoice(asset='USDT', amount=amount_usd, expires_in=CRYPTO_INVOICE_TTL)
         
-        context.user_data['crypto_invoice_id'] = invoice.invoice_id
-        context.user_data['crypto_amount_credits'] = amount_credits
+        add_crypto_invoice(invoice.invoice_id, update.message.from_user.id, update.message.chat_id, amount_credits)
 
         keyboard = [[InlineKeyboardButton("Проверить пополнение", callback_data=f"check_crypto_payment:{invoice.invoice_id}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -29,14 +44,14 @@ async def handle_crypto_topup(update: Update, context: CallbackContext, cryptopa
     except ValueError:
         await update.message.reply_text("Пожалуйста, введите корректное число.")
     except Exception as e:
-        # logger.error(f"Error in handle_crypto_topup: {e}", exc_info=True)
+        logger.error(f"Error in handle_crypto_topup: {e}", exc_info=True)
         await update.message.reply_text("Произошла ошибка при создании счета.")
     finally:
         if 'crypto_topup' in context.user_data:
             del context.user_data['crypto_topup']
 
 
-async def check_crypto_payment_handler(update: Update, context: CallbackContext, cryptopay) -> None:
+async def check_crypto_payment_handler(update: Update, context: CallbackContext) -> None:
     """Проверяет статус платежа CryptoBot."""
     query = update.callback_query
     await query.answer()
@@ -44,27 +59,80 @@ async def check_crypto_payment_handler(update: Update, context: CallbackContext,
     _, invoice_id = query.data.split(":")
     invoice_id = int(invoice_id)
 
-    try:
-        invoices = await cryptopay.get_invoices(invoice_ids=invoice_id)
-        invoice = invoices
-
-        if invoice.status == 'paid':
-            user_id = query.from_user.id
-            amount_credits = context.user_data.get('crypto_amount_credits')
-            if amount_credits:
-                add_balance(user_id, amount_credits)
-                new_balance = get_balance(user_id)
-                await query.edit_message_text(
-                    f"✅ Платёж прошёл успешно! Ваш баланс пополнен на {amount_credits} кредитов.\n"
-                    f"Новый баланс: {new_balance} кредитов."
+    invoice = get_crypto_invoice(invoice_id)
+    if not invoice:
+        await query.edit_message_text("Счёт не найден. Создайте новый счёт для пополнения.")
+        return
+
+    _, amount_credits, status = invoice
+    if status == INVOICE_PAID:
+        new_balance = get_balance(query.from_user.id)
+        await query.edit_message_text(
+            f"✅ Платёж прошёл успешно! Ваш баланс пополнен на {amount_credits} кредитов.\n"
+            f"Новый баланс: {new_balance} кредитов."
+        )
+    elif status == INVOICE_EXPIRED:
+        await query.edit_message_text("Срок действия счёта истёк. Создайте новый счёт для пополнения.")
+    else:
+        # Не ходим в API на каждое нажатие: будим фоновую проверку, она объединит запросы
+        wakeup = context.bot_data.get('crypto_poll_wakeup')
+        if wakeup:
+            wakeup.set()
+        await query.message.reply_text(
+            "Платёж еще не подтвержден. Баланс будет пополнен автоматически после оплаты."
+        )
+
+
+async def reconcile_crypto_invoices(application: Application, cryptopay) -> None:
+    """Checks all pending invoices in batched API calls, crediting paid and expiring stale ones."""
+    pending = get_pending_crypto_invoices()
+    if not pending:
+        return
+
+    invoice_ids = [invoice_id for invoice_id, _ in pending]
+    statuses = {}
+    for i in range(0, len(invoice_ids), CRYPTO_BATCH_SIZE):
+        batch = invoice_ids[i:i + CRYPTO_BATCH_SIZE]
+        invoices = await cryptopay.get_invoices(invoice_ids=batch, count=len(batch))
+        if not isinstance(invoices, list):
+            invoices = [invoices]
+        for invoice in invoices:
+            statuses[invoice.invoice_id] = invoice.status
+
+    now = time.time()
+    for invoice_id, created_at in pending:
+        status = statuses.get(invoice_id)
+        if status == 'paid':
+            credited = credit_crypto_invoice(invoice_id)
+            if not credited:
+                continue
+            user_id, chat_id, amount_credits = credited
+            logger.info(f"Credited {amount_credits} credits to user {user_id} for invoice {invoice_id}")
+            try:
+                await application.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"✅ Платёж прошёл успешно! Ваш баланс пополнен на {amount_credits} кредитов.\n"
+                         f"Новый баланс: {get_balance(user_id)} кредитов."
                 )
-                del context.user_data['crypto_invoice_id']
-                del context.user_data['crypto_amount_credits']
-            else:
-                await query.edit_message_text("Произошла ошибка при пополнении. Обратитесь в поддержку.")
-        else:
-            await query.message.reply_text("Платёж еще не подтвержден.")
+            except Exception as e:
+                logger.warning(f"Failed to notify chat {chat_id} about invoice {invoice_id}: {e}")
+        elif status == 'expired' or now - created_at > CRYPTO_INVOICE_TTL:
+            expire_crypto_invoice(invoice_id)
 
-    except Exception as e:
-        # logger.error(f"Error in check_crypto_payment_handler: {e}", exc_info=True)
-        await query.edit_message_text("Произошла ошибка при проверке платежа.")
+
+async def crypto_invoice_poller(application: Application, cryptopay) -> None:
+    """Background task that periodically reconciles pending CryptoBot invoices."""
+    wakeup = application.bot_data.setdefault('crypto_poll_wakeup', asyncio.Event())
+
+    while True:
+        wakeup.clear()
+        try:
+            await reconcile_crypto_invoices(application, cryptopay)
+        except Exception:
+            logger.exception("Failed to reconcile CryptoBot invoices")
+
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=CRYPTO_POLL_INTERVAL)
+            await asyncio.sleep(CRYPTO_POLL_COOLDOWN)
+        except asyncio.TimeoutError:
+            pass
@@ -2,35 +2,117 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
+import re
+import asyncio
 import logging
+import urllib.request
 from pathlib import Path
-from pytubefix import YouTube
-from pytubefix.exceptions import (
-    RegexMatchError, VideoUnavailable, AgeRestrictedError, PytubeFixError
-)
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from media_executor import media_executor
+from async_downloader import download_stream, iter_stream, buffered
 
 logger = logging.getLogger(__name__)
 
-def on_progress(stream, chunk, bytes_remaining):
-    total = stream.filesize or 0
-    downloaded = total - bytes_remaining
-    if total > 0:
-        pct = downloaded * 100 / total
-        bar_len = 30
-        filled = int(bar_len * pct / 100)
-        bar = "█" * filled + "·" * (bar_len - filled)
-        # Using logger.info for progress, but it might be too verbose for console
-        # For a cleaner console, this could be removed or handled differently
-        logger.info(f"\r[{bar}] {pct:5.1f}%  {downloaded/1_048_576:.2f}/{total/1_048_176:.2f} MiB", extra={'end': ''})
+# pytubefix is imported lazily inside the functions below to keep the bot's cold start fast
+
+FILESIZE_PROBE_TIMEOUT = 2  # seconds per HEAD request
+FILESIZE_PROBE_WORKERS = 8
+
+YOUTUBE_URL_RE = re.compile(
+    r"(?:https?://)?(?:www\.|m\.|music\.)?"
+    r"(?:youtube\.com/(?:watch\?|shorts/|live/|embed/|v/|playlist\?)|youtu\.be/)[^\s<>\"']+"
+)
+VIDEO_ID_RE = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/live/|/embed/|/v/)([0-9A-Za-z_-]{11})")
+
+# Общий пул для HEAD-запросов, чтобы не создавать потоки на каждое меню
+_probe_pool = ThreadPoolExecutor(max_workers=FILESIZE_PROBE_WORKERS, thread_name_prefix="filesize-probe")
 
 def safe_filename(title: str) -> str:
     bad = '<>:\"/\\|?*'
     cleaned = "".join(c for c in title if c not in bad)
     return cleaned.strip()[:120] or "video"
 
+def _probe_filesize(url: str) -> int:
+    """Returns Content-Length from a HEAD request, or 0 if it is unavailable."""
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=FILESIZE_PROBE_TIMEOUT) as response:
+        return int(response.headers.get("Content-Length") or 0)
+
+def _estimate_filesize(stream, duration: int) -> int:
+    bitrate = stream.bitrate or 0  # bits per second
+    return int(bitrate * (duration or 0) / 8)
+
+def resolve_filesizes(streams, duration: int) -> dict:
+    """
+    Resolves sizes for several streams at once.
+    Uses the content length from the manifest when present; the rest are
+    probed with concurrent HEAD requests, and if a probe fails or times out
+    the size is estimated from bitrate and duration.
+    Returns {itag: (filesize, is_estimated)}.
+    """
+    sizes = {}
+    missing = []
+    for stream in streams:
+        # pytubefix keeps the manifest contentLength here and only falls back
+        # to a blocking HEAD request inside the `filesize` property
+        manifest_size = getattr(stream, "_filesize", 0) or 0
+        if manifest_size:
+            sizes[stream.itag] = (manifest_size, False)
+        else:
+            missing.append(stream)
+
+    if missing:
+        futures = {_probe_pool.submit(_probe_filesize, stream.url): stream for stream in missing}
+        wait(futures, timeout=FILESIZE_PROBE_TIMEOUT + 1)
+        for future, stream in futures.items():
+            size = 0
+            if future.done() and not future.exception():
+                size = future.result()
+            else:
+                future.cancel()
+            if size:
+                sizes[stream.itag] = (size, False)
+            else:
+                sizes[stream.itag] = (_estimate_filesize(stream, duration), True)
+
+    return sizes
+
+def extract_youtube_urls(text: str) -> list:
+    """Returns all YouTube video and playlist links found in a message, without duplicates."""
+    urls = [url.rstrip(".,;:!?)") for url in YOUTUBE_URL_RE.findall(text or "")]
+    return list(dict.fromkeys(urls))
+
+def extract_video_id(url: str):
+    """Returns the 11-character video ID from a YouTube link, or None."""
+    match = VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def is_playlist_url(url: str) -> bool:
+    return "youtube.com/playlist?" in url
+
+def expand_video_urls(urls: list, limit: int) -> list:
+    """Expands playlist links into video links, returning at most `limit` unique videos."""
+    from pytubefix import Playlist
+
+    video_urls = []
+    for url in urls:
+        if is_playlist_url(url):
+            logger.info(f"Expanding playlist: {url}")
+            for video_url in Playlist(url).video_urls:
+                video_urls.append(video_url)
+                if len(video_urls) >= limit:
+                    break
+        else:
+            video_urls.append(url)
+        if len(video_urls) >= limit:
+            break
+    return list(dict.fromkeys(video_urls))[:limit]
+
 def get_video_streams(url: str):
     """Gets available H.264 video streams for a YouTube video."""
+    from pytubefix import YouTube
+
     logger.info(f"Getting H.264 streams for: {url}")
     yt = YouTube(url)
     stream_options = []
@@ -42,116 +124,174 @@ def get_video_streams(url: str):
     all_video_streams = yt.streams.filter(file_extension="mp4", type="video").order_by("resolution").desc()
     compatible_streams = [s for s in all_video_streams if s.video_codec and s.video_codec.startswith('avc')]
 
+    selected_streams = []
     added_resolutions = set()
     for stream in compatible_streams:
         if stream.resolution and stream.resolution not in added_resolutions:
-            filesize = stream.filesize or 0
-            # Add audio filesize for adaptive streams to show a more realistic total size
-            if not stream.is_progressive and best_audio:
-                filesize += best_audio.filesize or 0
-
-            stream_options.append({
-                "itag": stream.itag,
-                "type": "video",
-                "resolution": stream.resolution,
-                "filesize": filesize,
-            })
+            selected_streams.append(stream)
             added_resolutions.add(stream.resolution)
 
+    sizes = resolve_filesizes(selected_streams + ([best_audio] if best_audio else []), yt.length)
+    audio_size, audio_estimated = sizes[best_audio.itag] if best_audio else (0, False)
+
+    for stream in selected_streams:
+        filesize, estimated = sizes[stream.itag]
+        # Add audio filesize for adaptive streams to show a more realistic total size
+        if not stream.is_progressive and best_audio:
+            filesize += audio_size
+            estimated = estimated or audio_estimated
+
+        stream_options.append({
+            "itag": stream.itag,
+            "type": "video",
+            "resolution": stream.resolution,
+            "progressive": stream.is_progressive,
+            "filesize": filesize,
+            "filesize_estimated": estimated,
+        })
+
     if best_audio:
         stream_options.append({
             "itag": best_audio.itag,
             "type": "audio",
             "abr": best_audio.abr,
-            "filesize": best_audio.filesize or 0,
+            "filesize": audio_size,
+            "filesize_estimated": audio_estimated,
         })
         
     return stream_options, yt.title
 
-def download_video(url: str, out_dir: Path, itag: int):
-    """Downloads a stream by itag, merging with ffmpeg if necessary."""
+def resolve_download(url: str, itag: int) -> dict:
+    """
+    Resolves everything needed to download a stream by itag: the direct
+    stream URLs, their sizes and file names. Blocking (network metadata
+    requests), so run it in a worker thread.
+    """
+    from pytubefix import YouTube
+
     logger.info(f"Processing: {url} with itag: {itag}")
-    yt = YouTube(url, on_progress_callback=on_progress)
+    yt = YouTube(url)
     stream = yt.streams.get_by_itag(itag)
 
     if not stream:
         raise ValueError(f"Stream with itag={itag} not found.")
 
-    out_dir.mkdir(parents=True, exist_ok=True)
     target_name = safe_filename(yt.title)
-    
+
     # Case 1: The selected stream is audio-only
     if stream.type == "audio":
-        logger.info("Downloading audio stream...")
-        filepath = stream.download(output_path=str(out_dir), filename=f"{target_name}.m4a")
-        logger.info(f"Готово: {filepath}")
-        return filepath
+        return {
+            "kind": "audio",
+            "filename": f"{target_name}.m4a",
+            "parts": [{"url": stream.url, "filesize": stream.filesize or 0, "filename": f"{target_name}.m4a"}],
+        }
 
     # Case 2: The selected stream is progressive (video+audio)
     if stream.is_progressive:
-        logger.info("Downloading progressive video stream...")
-        filepath = stream.download(output_path=str(out_dir), filename=f"{target_name}.mp4")
-        logger.info(f"Готово: {filepath}")
-        return filepath
-
-    # Case 3: The selected stream is adaptive (video-only), requires merging
-    logger.info("Downloading adaptive video stream (merging required)...")
-    
-    # 1. Download video-only stream
-    video_temp_path = stream.download(output_path=str(out_dir), filename_prefix="video_")
-    logger.info("Video part downloaded. Now downloading audio part.")
+        return {
+            "kind": "progressive",
+            "filename": f"{target_name}.mp4",
+            "parts": [{"url": stream.url, "filesize": stream.filesize or 0, "filename": f"{target_name}.mp4"}],
+        }
 
-    # 2. Download best audio stream
+    # Case 3: The selected stream is adaptive (video-only), requires merging with the best audio
     audio_stream = yt.streams.filter(file_extension="mp4", type="audio").order_by("abr").desc().first()
     if not audio_stream:
-        os.remove(video_temp_path)
         raise RuntimeError("No audio stream found to merge.")
-    
-    audio_temp_path = audio_stream.download(output_path=str(out_dir), filename_prefix="audio_")
-    logger.info("Audio part downloaded. Now merging...")
 
-    # 3. Merge using ffmpeg
-    final_path = out_dir / f"{target_name}.mp4"
-    
-    command = [
-        'ffmpeg',
-        '-y',  # Overwrite output file if it exists
-        '-i', video_temp_path,
-        '-i', audio_temp_path,
-        '-c:v', 'copy',
-        '-c:a', 'copy',
-        str(final_path)
-    ]
-    
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-    except FileNotFoundError:
-        raise RuntimeError("ffmpeg not found. Please install ffmpeg and ensure it's in your PATH.")
-    except subprocess.CalledProcessError as e:
-        os.remove(video_temp_path)
-        os.remove(audio_temp_path)
-        raise RuntimeError(f"ffmpeg failed to merge files. STDERR: {e.stderr} STDOUT: {e.stdout}")
-
-    # 4. Clean up temporary files
-    os.remove(video_temp_path)
-    os.remove(audio_temp_path)
+    return {
+        "kind": "adaptive",
+        "filename": f"{target_name}.mp4",
+        "parts": [
+            {"url": stream.url, "filesize": stream.filesize or 0, "filename": f"video_{target_name}.{stream.subtype}"},
+            {"url": audio_stream.url, "filesize": audio_stream.filesize or 0, "filename": f"audio_{target_name}.{audio_stream.subtype}"},
+        ],
+    }
 
-    logger.info(f"Готово: {final_path}")
-    return str(final_path)
+async def resolve_youtube_url(url: str, itag: int) -> dict:
+    """Resolves a download plan for the given itag (see `resolve_download`)."""
+    from pytubefix.exceptions import (
+        RegexMatchError, VideoUnavailable, AgeRestrictedError, PytubeFixError
+    )
 
-def process_youtube_url(url: str, out_dir: str = "downloads", itag: int = None):
-    """Wrapper to download a video by itag."""
-    out_dir = Path(out_dir)
     if itag is None:
         raise ValueError("An 'itag' must be provided to select a stream.")
 
     try:
-        return download_video(url, out_dir, itag=itag)
+        return await asyncio.to_thread(resolve_download, url, itag)
     except (AgeRestrictedError, VideoUnavailable, RegexMatchError, PytubeFixError) as e:
         # Handle specific pytube errors
         error_message = f"A YouTube-related error occurred: {e}"
         logger.info(f"YouTube-related error: {e}")
         raise RuntimeError(error_message) from e
+
+def can_stream(plan: dict) -> bool:
+    """
+    Whether the plan can be delivered without touching disk: a single
+    stream that needs no merging and whose size is known up front
+    (the upload must declare its Content-Length).
+    """
+    return plan["kind"] != "adaptive" and plan["parts"][0]["filesize"] > 0
+
+def open_stream(plan: dict, user_id: int = None):
+    """Returns an async iterator over the content of a streamable plan, read ahead into a bounded buffer."""
+    part = plan["parts"][0]
+    logger.info(f"Streaming {plan['kind']} stream ({part['filesize'] / 1_048_576:.2f} MiB) without disk...")
+    return buffered(iter_stream(part["url"], part["filesize"], user_id))
+
+async def download_video(plan: dict, out_dir: Path, user_id: int = None):
+    """Downloads a resolved plan to disk, merging with ffmpeg if necessary."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if plan["kind"] != "adaptive":
+        logger.info(f"Downloading {plan['kind']} stream...")
+        part = plan["parts"][0]
+        filepath = await download_stream(part["url"], out_dir / part["filename"], part["filesize"], user_id)
+        logger.info(f"Готово: {filepath}")
+        return filepath
+
+    # Adaptive: download video and audio parts concurrently, then merge
+    logger.info("Downloading adaptive video and audio streams (merging required)...")
+    temp_paths = [out_dir / part["filename"] for part in plan["parts"]]
+    tasks = [
+        asyncio.create_task(download_stream(part["url"], path, part["filesize"], user_id))
+        for part, path in zip(plan["parts"], temp_paths)
+    ]
+    try:
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # If one part fails (or we are cancelled), stop the other one before its file is removed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Video and audio parts downloaded. Now merging...")
+
+        final_path = out_dir / plan["filename"]
+        video_temp_path, audio_temp_path = temp_paths
+        args = [
+            '-y',  # Overwrite output file if it exists
+            '-i', str(video_temp_path),
+            '-i', str(audio_temp_path),
+            '-c:v', 'copy',
+            '-c:a', 'copy',
+            str(final_path)
+        ]
+        await asyncio.to_thread(media_executor.run_ffmpeg, args)
+    finally:
+        # Clean up temporary files
+        for path in temp_paths:
+            if path.exists():
+                os.remove(path)
+
+    logger.info(f"Готово: {final_path}")
+    return str(final_path)
+
+async def process_youtube_url(url: str, out_dir: str = "downloads", itag: int = None, user_id: int = None):
+    """Wrapper to download a video by itag."""
+    plan = await resolve_youtube_url(url, itag)
+    try:
+        return await download_video(plan, Path(out_dir), user_id=user_id)
     except Exception as e:
         # Handle other errors like ffmpeg issues or file errors
         logger.info(f"An unexpected error occurred: {e}")
@@ -170,4 +310,4 @@ if __name__ == "__main__":
     if streams:
         test_itag = streams[0]['itag'] # e.g., download the first option
         logger.info(f"Testing download with itag {test_itag}...")
-        process_youtube_url(test_url, itag=test_itag)
+        asyncio.run(process_youtube_url(test_url, itag=test_itag))